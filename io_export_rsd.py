@@ -1,11 +1,20 @@
 """
 This script exports PlayStation SDK compatible RSD,PLY,MAT files from Blender.
-Supports normals, colors and texture mapped triangles.
+Supports normals and colored triangles, texture mapping is not supported yet.
 Only one mesh can be exported at a time.
 """
 
 import os
 import bpy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# numba is not bundled with Blender, if it is installed the MAT rows of very
+# large meshes are built by a compiled kernel instead of a Python loop
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 from bpy.props import (CollectionProperty,
                        StringProperty,
@@ -30,6 +39,251 @@ bl_info = {
     "category":     "Import-Export"
 }
 
+def get_array(collection, attr, dtype, width=1):
+    """Fetch a property of every item in a collection as an (N,) or (N,width) array."""
+    arr = np.empty(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, arr)
+    if width > 1:
+        arr = arr.reshape(-1, width)
+    return arr
+
+def get_vectors(collection, attr):
+    """Fetch a vector property of every item in a collection as an (N,3) array."""
+    # Fetching into RNA's own float32 type is a bulk copy, other types fall
+    # back to setting every element separately. The float64 conversion is
+    # exact and keeps the scaling math in double precision.
+    return get_array(collection, attr, np.float32, 3).astype(np.float64)
+
+# Parameters of Tom Forsyth's "Linear-Speed Vertex Cache Optimisation"
+VCACHE_SIZE = 32
+CACHE_DECAY_POWER = 1.5
+LAST_TRI_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+def _vertex_score(cache_pos, remaining):
+    """Score a vertex by its position in the cache and its number of unused triangles."""
+    if remaining == 0:
+        return -1.0
+    score = 0.0
+    if cache_pos >= 0:
+        if cache_pos < 3:
+            # The last triangle's vertices score lower so that it isn't
+            # simply repeated as a strip
+            score = LAST_TRI_SCORE
+        else:
+            score = (1.0 - (cache_pos - 3) / (VCACHE_SIZE - 3)) ** CACHE_DECAY_POWER
+    return score + VALENCE_BOOST_SCALE * remaining ** -VALENCE_BOOST_POWER
+
+def optimize_vertex_cache(triangles, vertex_count):
+    """Return an order of the triangles that makes good use of a vertex cache.
+    
+    Implements Tom Forsyth's "Linear-Speed Vertex Cache Optimisation". When
+    no triangle in the cache is left the next unused one in the original
+    order is taken, which keeps the whole pass linear.
+    """
+    vert_tris = [[] for v in range(vertex_count)]
+    for t,tri in enumerate(triangles):
+        for v in tri:
+            vert_tris[v].append(t)
+    
+    cache_pos = [-1] * vertex_count
+    vert_score = [_vertex_score(-1, len(tris)) for tris in vert_tris]
+    tri_score = [vert_score[a] + vert_score[b] + vert_score[c] for a,b,c in triangles]
+    emitted = [False] * len(triangles)
+    
+    order = []
+    cache = []
+    next_tri = 0
+    best = max(range(len(triangles)), key=tri_score.__getitem__, default=-1)
+    
+    while len(order) < len(triangles):
+        
+        if best < 0:
+            while emitted[next_tri]:
+                next_tri += 1
+            best = next_tri
+        
+        order.append(best)
+        emitted[best] = True
+        tri = triangles[best]
+        for v in tri:
+            vert_tris[v].remove(best)
+        
+        # Move the triangle's vertices to the front of the cache
+        new_cache = list(dict.fromkeys(tri))
+        new_cache += [v for v in cache if v not in new_cache]
+        cache = new_cache[:VCACHE_SIZE]
+        evicted = new_cache[VCACHE_SIZE:]
+        for v in evicted:
+            cache_pos[v] = -1
+        for pos,v in enumerate(cache):
+            cache_pos[v] = pos
+        
+        # Update the scores of every vertex that moved and their triangles
+        for v in cache + evicted:
+            score = _vertex_score(cache_pos[v], len(vert_tris[v]))
+            delta = score - vert_score[v]
+            vert_score[v] = score
+            for t in vert_tris[v]:
+                tri_score[t] += delta
+        
+        # The next triangle is the best one that uses a cached vertex
+        best = -1
+        best_score = -1.0
+        for v in cache:
+            for t in vert_tris[v]:
+                if tri_score[t] > best_score:
+                    best = t
+                    best_score = tri_score[t]
+    
+    return order
+
+# Converts Blender's (X, Y, Z) to the PlayStation's (X, -Z, Y) when a row
+# vector is multiplied by it
+AXIS_MATRIX = np.array([[1.0, 0.0,  0.0],
+                        [0.0, 0.0,  1.0],
+                        [0.0, -1.0, 0.0]])
+
+def to_psx_axes(vectors, scale=1.0):
+    """Convert an (N,3) array of vectors to PlayStation axes and scale them."""
+    return vectors @ (AXIS_MATRIX * scale)
+
+def format_rows(fmt, arr):
+    """Format every row of a 2D array with fmt and return them as one string."""
+    return (fmt * len(arr)) % tuple(arr.ravel().tolist())
+
+def encode_text(text):
+    """Encode text for a binary file, with the same line endings text mode would use."""
+    if os.linesep != "\n":
+        text = text.replace("\n", os.linesep)
+    return text.encode("ascii")
+
+def append_text(buf, text):
+    """Encode text and add it to the end of a bytearray."""
+    buf += encode_text(text)
+
+def write_file(filepath, data):
+    """Write str data in text mode or bytes data in binary mode."""
+    mode = "w" if isinstance(data, str) else "wb"
+    with open(filepath, mode) as f:
+        f.write(data)
+
+# Row formats for the PLY file
+VECTOR_FMT = "%E %E %E\n"
+POLYGON_FMT = "0 %d %d %d 0 %d %d %d 0\n"
+
+# Row formats for the MAT file, according to filefrmt.pdf, section 2-10,
+# figure 2-15, "(4th vertex is 0,0,0 for triangles)"
+MAT_FLAT_FMT = "%d\t 0 %s C %d %d %d \n"
+MAT_GOURAUD_FMT = "%d\t 0 %s G %d %d %d %d %d %d %d %d %d 0 0 0\n"
+
+def _append_mat_rows_python(buf, tri_cols, is_flat, smooth):
+    """Format the MAT rows of colored triangles and add them to the end of a bytearray."""
+    parts = []
+    append = parts.append
+    for i,(cols,flat,smooth_shaded) in enumerate(zip(tri_cols.tolist(), is_flat.tolist(), smooth.tolist())):
+        
+        # Set flat or gouraud
+        shading = "G" if smooth_shaded else "F"
+        
+        if flat:
+            c = cols[0]
+            append(MAT_FLAT_FMT % (i, shading, c[0], c[1], c[2]))
+        else:
+            c0, c1, c2 = cols
+            append(MAT_GOURAUD_FMT % (i, shading,
+                                      c0[0], c0[1], c0[2],
+                                      c2[0], c2[1], c2[2],
+                                      c1[0], c1[1], c1[2]))
+    append_text(buf, "".join(parts))
+
+if njit is not None:
+    
+    # cache=True keeps the compiled kernels on disk, so they are only
+    # compiled once instead of on the first export of every session
+    @njit(cache=True)
+    def _put_int(out, pos, value):
+        """Write a non-negative integer as ASCII digits into out at pos, return the new position."""
+        start = pos
+        while True:
+            out[pos] = 48 + value % 10
+            pos += 1
+            value //= 10
+            if value == 0:
+                break
+        # Digits were written least significant first
+        out[start:pos] = out[start:pos][::-1].copy()
+        return pos
+    
+    @njit(cache=True)
+    def _build_mat_rows(tri_cols, is_flat, smooth, out):
+        """Write the same text as MAT_FLAT_FMT and MAT_GOURAUD_FMT into out, return its length."""
+        pos = 0
+        for i in range(len(is_flat)):
+            pos = _put_int(out, pos, i)
+            out[pos:pos+4] = (9, 32, 48, 32)            # "\t 0 "
+            out[pos+4] = 71 if smooth[i] else 70        # "G" or "F"
+            out[pos+5] = 32
+            pos += 6
+            if is_flat[i]:
+                out[pos] = 67                           # "C"
+                out[pos+1] = 32
+                pos += 2
+                for k in range(3):
+                    pos = _put_int(out, pos, tri_cols[i, 0, k])
+                    out[pos] = 32
+                    pos += 1
+            else:
+                out[pos] = 71                           # "G"
+                out[pos+1] = 32
+                pos += 2
+                for j in (0, 2, 1):
+                    for k in range(3):
+                        pos = _put_int(out, pos, tri_cols[i, j, k])
+                        out[pos] = 32
+                        pos += 1
+                out[pos:pos+5] = (48, 32, 48, 32, 48)   # "0 0 0"
+                pos += 5
+            out[pos] = 10
+            pos += 1
+        return pos
+    
+    # A gouraud row is at most about 60 characters long
+    MAT_ROW_MAX = 80
+    
+    def _append_mat_rows_numba(buf, tri_cols, is_flat, smooth):
+        """Format the MAT rows of colored triangles and add them to the end of a bytearray."""
+        out = np.empty(len(is_flat) * MAT_ROW_MAX, dtype=np.uint8)
+        length = _build_mat_rows(tri_cols, is_flat, smooth, out)
+        if os.linesep != "\n":
+            buf += out[:length].tobytes().replace(b"\n", os.linesep.encode("ascii"))
+        else:
+            buf += memoryview(out[:length])
+else:
+    _append_mat_rows_numba = None
+
+# Compiling the numba kernel takes seconds, which only pays off on very
+# large meshes
+NUMBA_MIN_TRIANGLES = 1000000
+
+def append_mat_rows(buf, tri_cols, is_flat, smooth):
+    """Format the MAT rows of colored triangles and add them to the end of a bytearray.
+    
+    Uses the numba kernel for very large meshes if it is available, and the
+    Python formatter otherwise or if the kernel fails to compile.
+    """
+    global _append_mat_rows_numba
+    if _append_mat_rows_numba is not None and len(is_flat) >= NUMBA_MIN_TRIANGLES:
+        try:
+            # buf is only extended once the kernel has succeeded
+            _append_mat_rows_numba(buf, tri_cols, is_flat, smooth)
+            return
+        except Exception as e:
+            print("RSD export: numba kernel failed, using the Python formatter instead: %s" % e)
+            _append_mat_rows_numba = None
+    _append_mat_rows_python(buf, tri_cols, is_flat, smooth)
+
 class ExportRSD(bpy.types.Operator, ExportHelper):
     
     bl_idname       = "export_mesh.rsd"
@@ -59,23 +313,21 @@ class ExportRSD(bpy.types.Operator, ExportHelper):
         min=0.01, max=1000.0,
         default=1.0,
         )
+    
+    exp_optimizeVertexCache: BoolProperty(
+        name="Optimize Vertex Cache",
+        description="Reorder polygons so that neighbouring polygons are "
+                    "stored close together, for better vertex cache use.",
+        default=False,
+        )
         
     def execute(self, context):
         
-        # Trivia: bpy.path.ensure_ext got borked in newer versions of Blender due to a 'fix' introduced in
-        # Thu Sep 3 13:09:16 2015 +0200 so I had to use this messy trick to get extensions to work properly
-        #
-        # Said 'bugfix' addresses the issue in bpy.path.ensure_ext with extensions with double periods (such as .tar.gz)
-        # but it also breaks its intended function of adding or replacing an existing file extension with the specified
-        # extension. This 'bugfix' still persists in 2.76b and no one but I (lameguy64) seems to notice this problem
-        # probably because I'm the only one making export plugins that output more than one file in different extensions
-        # so I doubt this will ever get fixed.
-        
-        filepath = self.filepath
-        filepath = filepath.rstrip(self.filename_ext) # Quick fix to get around the aforementioned 'bugfix'
-        rsd_filepath = bpy.path.ensure_ext(filepath, self.filename_ext)
-        ply_filepath = bpy.path.ensure_ext(filepath, '.ply')
-        mat_filepath = bpy.path.ensure_ext(filepath, '.mat')
+        # All three files share the same name, only the extension differs
+        base_filepath = os.path.splitext(self.filepath)[0]
+        rsd_filepath = base_filepath + self.filename_ext
+        ply_filepath = base_filepath + '.ply'
+        mat_filepath = base_filepath + '.mat'
         
         # Get object context
         obj = context.object
@@ -83,169 +335,113 @@ class ExportRSD(bpy.types.Operator, ExportHelper):
         # Get mesh
         if self.exp_applyModifiers:
             depsgraph = context.evaluated_depsgraph_get()
-            mesh = obj.evaluated_get(depsgraph).to_mesh()
+            mesh_obj = obj.evaluated_get(depsgraph)
         else:
-            mesh = obj.to_mesh()
+            mesh_obj = obj
+        mesh = mesh_obj.to_mesh()
+        
+        # The temporary mesh has to be freed even if writing fails
+        try:
+            self.write_mesh(mesh, rsd_filepath, ply_filepath, mat_filepath)
+        finally:
+            mesh_obj.to_mesh_clear()
+            
+        return {'FINISHED'}
+    
+    def write_mesh(self, mesh, rsd_filepath, ply_filepath, mat_filepath):
         
         if not mesh.loop_triangles and mesh.polygons:
             mesh.calc_loop_triangles()
         
-        # Write PLY file
-        with open(ply_filepath, "w") as f:
-            
-            f.write("@PLY940102\n")
-            f.write("%d %d %d\n" % (len(mesh.vertices), (len(mesh.vertices)+len(mesh.loop_triangles)), len(mesh.loop_triangles)))
-            
-            # Write vertices
-            f.write("# Vertices\n")
-            for v in mesh.vertices:
-                f.write("%E %E %E\n" % (v.co.x * self.exp_scaleFactor, -v.co.z * self.exp_scaleFactor, v.co.y * self.exp_scaleFactor))
-
-            # Write normals
-            f.write("# Normals\n")
-            f.write("# Smooth normals begin here\n")
-            for v in mesh.vertices:
-                f.write("%E %E %E\n" % (v.normal.x, -v.normal.z, v.normal.y))
-                
-            f.write("# Flat normals begin here\n")
-            flatnorms_start = len(mesh.vertices)
-            for p in mesh.loop_triangles:
-                f.write("%E %E %E\n" % (p.normal.x, -p.normal.z, p.normal.y))
+        # loop_triangles are always triangles so there are no quads to handle
+        tri_verts = get_array(mesh.loop_triangles, "vertices", np.int32, 3)
+        use_smooth = get_array(mesh.loop_triangles, "use_smooth", bool)
+        tri_loops = get_array(mesh.loop_triangles, "loops", np.int32, 3)
+        tri_normals = get_vectors(mesh.loop_triangles, "normal")
+        
+        if self.exp_optimizeVertexCache:
+            order = optimize_vertex_cache(tri_verts.tolist(), len(mesh.vertices))
+            tri_verts = tri_verts[order]
+            use_smooth = use_smooth[order]
+            tri_loops = tri_loops[order]
+            tri_normals = tri_normals[order]
+        
+        # Build PLY file
+        # Sections are encoded straight into one buffer per file instead
+        # of joining them into another large string first
+        ply_data = bytearray()
+        
+        # Flat normals are only needed if some polygons aren't smooth shaded
+        write_flat_normals = not use_smooth.all()
+        normal_count = len(mesh.vertices)
+        if write_flat_normals:
+            normal_count += len(mesh.loop_triangles)
+        
+        append_text(ply_data, "@PLY940102\n")
+        append_text(ply_data, "%d %d %d\n" % (len(mesh.vertices), normal_count, len(mesh.loop_triangles)))
+        
+        # Write vertices (Y and Z are swapped and Y is flipped)
+        append_text(ply_data, "# Vertices\n")
+        co = get_vectors(mesh.vertices, "co")
+        append_text(ply_data, format_rows(VECTOR_FMT, to_psx_axes(co, self.exp_scaleFactor)))
 
-            # Write polygons
-            f.write("# Polygon\n")
-            for i,p in enumerate(mesh.loop_triangles):
-                
-                # Write vertex indices
-                if len(p.vertices) == 3:
-                    f.write("0 %d %d %d 0 " % (p.vertices[0], p.vertices[2], p.vertices[1]))
-                elif len(p.vertices) == 4:
-                    f.write("1 %d %d %d %d " % (p.vertices[3], p.vertices[2], p.vertices[0], p.vertices[1]))
-                
-                # Write normal indices and shading mode
-                if p.use_smooth:
-                    if len(p.vertices) == 3:
-                        f.write("%d %d %d 0" % (p.vertices[0], p.vertices[2], p.vertices[1]))
-                    elif len(p.vertices) == 4:
-                        f.write("%d %d %d %d" % (p.vertices[3], p.vertices[2], p.vertices[0], p.vertices[1]))
-                else:
-                    n = flatnorms_start+i
-                    if len(p.vertices) == 3:
-                        f.write("%d %d %d 0" % (n, n, n))
-                    elif len(p.vertices) == 4:
-                        f.write("%d %d %d %d" % (n, n, n, n))
-                    
-                f.write("\n")
+        # Write normals
+        append_text(ply_data, "# Normals\n")
+        append_text(ply_data, "# Smooth normals begin here\n")
+        normals = get_vectors(mesh.vertices, "normal")
+        append_text(ply_data, format_rows(VECTOR_FMT, to_psx_axes(normals)))
             
-        # Write MAT file
-        with open(mat_filepath, "w") as f:
+        append_text(ply_data, "# Flat normals begin here\n")
+        flatnorms_start = len(mesh.vertices)
+        if write_flat_normals:
+            append_text(ply_data, format_rows(VECTOR_FMT, to_psx_axes(tri_normals)))
+
+        # Write polygons
+        append_text(ply_data, "# Polygon\n")
+        # Smooth triangles use the vertex normals, flat ones their own normal
+        indices = tri_verts[:, [0, 2, 1]]
+        flat_normals = np.arange(flatnorms_start, flatnorms_start+len(indices))
+        normal_indices = np.where(use_smooth[:, None], indices, flat_normals[:, None])
+        append_text(ply_data, format_rows(POLYGON_FMT, np.hstack((indices, normal_indices))))
         
-            f.write("@MAT940801\n")
-            f.write("%d\n" % len(mesh.loop_triangles))
-            
-            
-            if mesh.vertex_colors:
-                mesh_cols = mesh.vertex_colors.active.data
-            else:
-                mesh_cols = None
-                
-            for i,p in enumerate(mesh.loop_triangles):
-                
-                f.write("%d\t 0 " % i)
-                
-                # Set flat or gouraud
-                if p.use_smooth:
-                    f.write("G ")
-                else:
-                    f.write("F ")
-                    
-                # So that vertex colors will be correct for textured polys
-                color_mul = 255.0
-                pol_textured = False
-                    
-                # Check if polygon is flat or gouraud shaded
-                if mesh_cols is not None:
-                    col = [mesh_cols[loop_index].color[:] for loop_index in p.loops]
-                    # Check if polygon is flat shaded
-                    if (col[0] == col[1]) and (col[1] == col[2]) and (col[2] == col[0]):
-                        # is flat...
-                        pol_gouraud = False
-                    else:
-                        # is gouraud...
-                        pol_gouraud = True
-                else:
-                    pol_gouraud = False
-                    
-                # Write texture coordinates
-                if pol_textured:
-                    if self.exp_coloredTexPolys:
-                        if pol_gouraud:
-                            f.write("H ")
-                        else:
-                            f.write("D ")
-                    else:
-                        f.write("T ")
-                    f.write("%d " % (tex_table[i]-1))
-                    uv = [mesh_uvs[loop_index].uv for loop_index in p.loops]
-                    if len(p.vertices) == 3:
-                        uv = (uv[0],
-                              uv[2],
-                              uv[1],
-                              )
-                    elif len(p.vertices) == 4:
-                        uv = (uv[3],
-                              uv[2],
-                              uv[0],
-                              uv[1]
-                              )
-                    tex_w = 1024
-                    tex_h = 512
-                    for j,c in enumerate(p.vertices):
-                        f.write("%d %d " % (round(tex_w*uv[j].x), round(tex_h-(tex_h*uv[j].y))))
-                    if len(p.vertices) == 3:
-                        f.write("0 0 ")
-                else:
-                    if pol_gouraud:
-                        f.write("G ")
-                    else:
-                        f.write("C ")
-                        
-                # Write vertex colors
-                if mesh_cols is not None:
-                    if self.exp_coloredTexPolys or not pol_textured:
-                        if pol_gouraud:
-                            if len(p.vertices) == 4:
-                                index_tab = [ 3, 2, 0, 1 ]
-                            else:
-                                index_tab = [ 0, 2, 1 ]
-                            for j,c in enumerate(p.vertices):
-                                color = col[index_tab[j]]
-                                color = (int(color[0]*color_mul), int(color[1]*color_mul), int(color[2]*color_mul))
-                                f.write("%d %d %d " % (color[0], color[1], color[2]))
-                            # according to filefrmt.pdf, section 2-10, figure 2-15, "(4th vertex is 0,0,0 for triangles)"
-                            if len(p.vertices) == 3:
-                                f.write("0 0 0")
-                        else:
-                            color = col[0]
-                            color = (int(color[0]*color_mul),
-                                     int(color[1]*color_mul),
-                                     int(color[2]*color_mul),
-                                     )
-                            f.write("%d %d %d " % color[:])
-                else:
-                    f.write("%d %d %d " % (color_mul, color_mul, color_mul))
-                    
-                f.write("\n")
+        # Build MAT file
+        mat_data = bytearray()
         
-        # Write RSD file        
-        with open(rsd_filepath, "w") as f:
-            f.write("@RSD940102\n")
-            f.write("PLY=%s\n" % bpy.path.basename(ply_filepath))
-            f.write("MAT=%s\n" % bpy.path.basename(mat_filepath))
-            f.write("NTEX=0\n")
-            f.close()
-            
-        return {'FINISHED'}
+        append_text(mat_data, "@MAT940801\n")
+        append_text(mat_data, "%d\n" % len(mesh.loop_triangles))
+        
+        if mesh.vertex_colors:
+            # Fetched as float32 like get_vectors so foreach_get can bulk copy
+            loop_cols = get_array(mesh.vertex_colors.active.data, "color", np.float32, 4).astype(np.float64)
+            tri_cols = loop_cols[tri_loops]
+            # A polygon is flat shaded if all of its vertex colors are the same
+            is_flat = (np.all(tri_cols[:, 0] == tri_cols[:, 1], axis=1) &
+                       np.all(tri_cols[:, 1] == tri_cols[:, 2], axis=1))
+            tri_cols = np.clip(tri_cols[..., :3] * 255.0, 0, 255).astype(np.uint8)
+        else:
+            # Polygons are white when the mesh has no vertex colors
+            tri_cols = np.full((len(use_smooth), 3, 3), 255, dtype=np.uint8)
+            is_flat = np.ones(len(use_smooth), dtype=bool)
+        
+        # TODO: Textured polygons (and exp_coloredTexPolys) are not
+        # supported yet, every polygon is exported as a colored one
+        append_mat_rows(mat_data, tri_cols, is_flat, use_smooth)
+        
+        # Build RSD file, it is kept as text since the file names in it
+        # don't have to be ASCII
+        rsd_data = ("@RSD940102\n"
+                    "PLY=%s\n"
+                    "MAT=%s\n"
+                    "NTEX=0\n" % (bpy.path.basename(ply_filepath), bpy.path.basename(mat_filepath)))
+        
+        # The files don't depend on each other, so write them all at once
+        files = ((ply_filepath, ply_data),
+                 (mat_filepath, mat_data),
+                 (rsd_filepath, rsd_data),
+                 )
+        with ThreadPoolExecutor(len(files)) as pool:
+            # list() so that errors from the writes are raised here
+            list(pool.map(lambda file: write_file(*file), files))
     
     
 # For registering to Blender menus